@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Приоритетные очереди для исходящих запросов к Discord API.
+
+Все REST-запросы бота проходят через один HTTPClient, поэтому большая настройка сервера
+или проход статистики может надолго занять его сотнями запросов. Планировщик делит
+трафик на полосы:
+  - LANE_INTERACTIVE - ответы на команды и все, что не помечено явно; идут сразу, без очереди;
+  - LANE_BULK        - массовая работа (/setup-server и т.п.), не более BULK_SLOTS запросов одновременно;
+  - LANE_BACKGROUND  - фоновая статистика, только когда массовой работе ничего не нужно.
+
+Ответы на взаимодействия (respond/followup/edit) discord.py отправляет через отдельный
+webhook-адаптер, мимо HTTPClient, так что их очередь массовые запросы и так не задерживают.
+
+Модуль лежит рядом с main.py, а не в cogs/, потому что main.py загружает каждый файл
+из cogs/ как расширение и создает новый объект модуля, а полоса хранится в ContextVar,
+который должен быть одним на весь процесс.
+"""
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+from typing import Any, List, Tuple
+
+LANE_INTERACTIVE = 0
+LANE_BULK = 1
+LANE_BACKGROUND = 2
+
+# Сколько запросов массовой работы может выполняться одновременно. Эти слоты только для нее.
+BULK_SLOTS = 4
+# Сколько фоновых запросов может выполняться одновременно; стартуют они, только пока массовых нет.
+BACKGROUND_SLOTS = 1
+
+# Полоса текущей задачи. asyncio копирует контекст в создаваемые задачи,
+# поэтому достаточно задать полосу один раз на входе в массовую/фоновую работу.
+api_lane: contextvars.ContextVar[int] = contextvars.ContextVar('api_lane', default=LANE_INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(lane: int):
+    """Выполняет вложенный код (и созданные в нем задачи) в указанной полосе."""
+    token = api_lane.set(lane)
+    try:
+        yield
+    finally:
+        api_lane.reset(token)
+
+
+class ApiScheduler:
+    """Оборачивает `HTTPClient.request` и выдает слоты запросам по приоритету полосы."""
+
+    def __init__(self, bulk_slots: int = BULK_SLOTS, background_slots: int = BACKGROUND_SLOTS):
+        self.capacity = {LANE_BULK: bulk_slots, LANE_BACKGROUND: background_slots}
+        # Счетчики раздельные: фоновый запрос, застрявший в ожидании 429 (например, лимит
+        # переименований канала), не занимает слот массовой работы
+        self.in_flight = {LANE_BULK: 0, LANE_BACKGROUND: 0}
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+        self.original_request = None
+
+    def install(self, http) -> "ApiScheduler":
+        """Подменяет `http.request` на версию с очередями."""
+        self.original_request = http.request
+
+        async def request(route, **kwargs: Any):
+            lane = api_lane.get()
+            if lane == LANE_INTERACTIVE:
+                return await self.original_request(route, **kwargs)
+            await self._acquire(lane)
+            try:
+                return await self.original_request(route, **kwargs)
+            finally:
+                self._release(lane)
+
+        http.request = request
+        return self
+
+    def _can_start(self, lane: int) -> bool:
+        if self.in_flight[lane] >= self.capacity[lane]:
+            return False
+        if lane == LANE_BACKGROUND:
+            # Фону достается только свободная пропускная способность
+            return self.in_flight[LANE_BULK] == 0 and not any(waiting_lane == LANE_BULK for waiting_lane, _, _ in self.waiters)
+        return True
+
+    async def _acquire(self, lane: int):
+        # Без очереди стартуем, только если никто из той же полосы не ждет раньше нас
+        if self._can_start(lane) and not any(waiting_lane == lane for waiting_lane, _, _ in self.waiters):
+            self.in_flight[lane] += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (lane, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже был выдан - возвращаем его следующему
+                self._release(lane)
+            else:
+                self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+                heapq.heapify(self.waiters)
+                self._wake()
+            raise
+
+    def _release(self, lane: int):
+        self.in_flight[lane] -= 1
+        self._wake()
+
+    def _wake(self):
+        # Будим ожидающих строго по приоритету: пока массовая работа ждет, фон стоит за ней
+        while self.waiters:
+            lane, _, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._can_start(lane):
+                break
+            heapq.heappop(self.waiters)
+            self.in_flight[lane] += 1
+            future.set_result(None)
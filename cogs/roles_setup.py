@@ -3,22 +3,380 @@
 Модуль для полной настройки сервера: роли + приватность каналов.
 """
 import asyncio
+import importlib.util
 import os
 import json
 import io
-from typing import Any, Dict, List, Optional, Union
+import sqlite3
+import sys
+import time
+from array import array
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import discord
 from discord.ext import commands
 
+from api_scheduler import LANE_BULK, priority
+
 from . import roles_config
 
+# Локальная копия структуры каналов главного сервера.
+STRUCTURE_FILE_PATH = "main_server_structure.json"
+
+# Сколько участников одновременно получают роли обратно после пересоздания.
+ROLE_RESTORE_CONCURRENCY = 5
+
+# Локальная база (общая со статистикой), где снимок ролей лежит, пока роли пересоздаются.
+# Если бот упадет посреди настройки, следующий /setup-server вернет роли из этого снимка.
+SNAPSHOT_DB_PATH = "bot_state.sqlite3"
+
+# Сообщение с прогрессом редактируется только при смене этапа или продвижении этапа
+# на PROGRESS_STEP_PERCENT процентов, и не чаще раза в PROGRESS_EDIT_INTERVAL секунд.
+PROGRESS_STEP_PERCENT = 10
+PROGRESS_EDIT_INTERVAL = 10.0
+# В долгих этапах без заметного продвижения сообщение обновляется раз в этот интервал (в секундах).
+PROGRESS_HEARTBEAT_INTERVAL = 60.0
+# Окно (в секундах), по которому считается текущая скорость запросов к API, и его минимум,
+# чтобы сразу после старта не показывать скорость по одному-двум запросам.
+PROGRESS_RATE_WINDOW = 15.0
+PROGRESS_RATE_MIN_WINDOW = 5.0
+# Токен взаимодействия живет 15 минут; после этого срока сообщение больше не редактируем.
+INTERACTION_TOKEN_TTL = 14 * 60
+
+# Таблицы поиска, собранные из roles_config. Сбрасываются при перезагрузке конфига.
+_compiled_config: Optional[Dict[str, Any]] = None
+
+
+def _compile_config(config) -> Dict[str, Any]:
+    role_names = [role_data.get('name') for role_data in config.ROLES_STRUCTURE]
+    return {
+        'role_names': role_names,
+        'role_index': {name: i for i, name in enumerate(role_names) if name},
+        'staff_role_names': {role_data['role_type']: role_data['name'] for role_data in config.ROLES_STRUCTURE if 'role_type' in role_data},
+    }
+
+
+def get_compiled_config(config=None) -> Dict[str, Any]:
+    """
+    Возвращает таблицы поиска по конфигу. Для текущего roles_config они собираются один раз
+    и кешируются; для старого конфига, к которому привязан уже идущий запуск, собираются заново.
+    """
+    global _compiled_config
+    if config is not None and config is not roles_config:
+        return _compile_config(config)
+    if _compiled_config is None:
+        _compiled_config = _compile_config(roles_config)
+    return _compiled_config
+
+
+def invalidate_compiled_config():
+    """Сбрасывает таблицы поиска; они пересоберутся из нового конфига при следующем обращении."""
+    global _compiled_config
+    _compiled_config = None
+
+
+def validate_config_module(module) -> None:
+    """Проверяет загруженный модуль конфига. Бросает ValueError с описанием первой найденной ошибки."""
+    for attr in ('PROTECTED_CHANNELS', 'ROLES_STRUCTURE', 'CHANNEL_PERMISSIONS', 'CHANNEL_CONFIG', 'P_NO_PERMS'):
+        if not hasattr(module, attr):
+            raise ValueError(f"в конфиге нет `{attr}`")
+
+    seen_names = set()
+    for role_data in module.ROLES_STRUCTURE:
+        name = role_data.get('name') if isinstance(role_data, dict) else None
+        if not name:
+            raise ValueError(f"роль без имени: {role_data!r}")
+        if name in seen_names:
+            raise ValueError(f"роль `{name}` указана дважды")
+        seen_names.add(name)
+        if not isinstance(role_data.get('permissions', module.P_NO_PERMS), discord.Permissions):
+            raise ValueError(f"у роли `{name}` права должны быть discord.Permissions")
+
+    for scheme, permission_data in module.CHANNEL_PERMISSIONS.items():
+        for role_key, overwrite in permission_data.items():
+            if not isinstance(overwrite, discord.PermissionOverwrite):
+                raise ValueError(f"в схеме `{scheme}` для `{role_key}` ожидается discord.PermissionOverwrite")
+
+    for map_name in ('category_map', 'channel_map'):
+        if map_name not in module.CHANNEL_CONFIG:
+            raise ValueError(f"в CHANNEL_CONFIG нет `{map_name}`")
+        for item_name, scheme in module.CHANNEL_CONFIG[map_name].items():
+            if scheme not in module.CHANNEL_PERMISSIONS:
+                raise ValueError(f"`{item_name}` ссылается на несуществующую схему прав `{scheme}`")
+
+
+def validate_structure(structure: Any) -> None:
+    """Проверяет структуру каналов из файла. Бросает ValueError с описанием первой найденной ошибки."""
+    if not isinstance(structure, dict) or not isinstance(structure.get('categories'), list):
+        raise ValueError("в структуре нет списка `categories`")
+    for cat_data in structure['categories']:
+        if not isinstance(cat_data, dict) or not isinstance(cat_data.get('channels', {}), dict):
+            raise ValueError(f"некорректная категория: {cat_data!r}")
+        for chan_type in ('text', 'voice'):
+            for chan_info in cat_data.get('channels', {}).get(chan_type, []):
+                if not isinstance(chan_info, dict) or not chan_info.get('name'):
+                    raise ValueError(f"канал без имени в категории `{cat_data.get('name')}`")
+
+
+def load_structure(path: str = STRUCTURE_FILE_PATH) -> Dict:
+    """Читает и проверяет файл структуры каналов."""
+    with open(path, 'r', encoding='utf-8') as f:
+        structure = json.load(f)
+    validate_structure(structure)
+    return structure
+
+
+def reload_config_module():
+    """
+    Загружает roles_config.py заново в отдельный объект модуля, проверяет его
+    и только после этого подменяет текущий конфиг. При ошибке старый конфиг остается в силе.
+    """
+    global roles_config
+    spec = importlib.util.spec_from_file_location(roles_config.__name__, roles_config.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    validate_config_module(module)
+
+    sys.modules[roles_config.__name__] = module
+    package = sys.modules.get(__package__)
+    if package is not None:
+        setattr(package, 'roles_config', module)
+    roles_config = module
+    invalidate_compiled_config()
+    return module
+
+
+class RoleSnapshot:
+    """
+    Компактный снимок выданных ролей: для каждого участника хранится битовая маска,
+    где бит N соответствует позиции N в `ROLES_STRUCTURE`.
+    ID и маски лежат в плоских массивах `array('Q')`, а не в словарях на участника,
+    поэтому 100k участников занимают порядка 1.6 МБ.
+    """
+
+    def __init__(self, role_names: List[str]):
+        self.role_names = role_names
+        self.words = max(1, (len(role_names) + 63) // 64)
+        self.member_ids = array('Q')
+        self.masks = array('Q')
+
+    @classmethod
+    def capture(cls, guild: discord.Guild, config=None) -> "RoleSnapshot":
+        """Снимает маски ролей из конфига со всех участников сервера."""
+        compiled = get_compiled_config(config)
+        snapshot = cls(compiled['role_names'])
+        index_by_name = compiled['role_index']
+        word_mask = (1 << 64) - 1
+
+        for member in guild.members:
+            mask = 0
+            for role in member.roles:
+                index = index_by_name.get(role.name)
+                if index is not None:
+                    mask |= 1 << index
+            # Участников без управляемых ролей не храним вовсе
+            if not mask:
+                continue
+            snapshot.member_ids.append(member.id)
+            for _ in range(snapshot.words):
+                snapshot.masks.append(mask & word_mask)
+                mask >>= 64
+        return snapshot
+
+    def __len__(self) -> int:
+        return len(self.member_ids)
+
+    def role_indexes(self, position: int) -> List[int]:
+        """Возвращает позиции в `ROLES_STRUCTURE` для участника с порядковым номером `position`."""
+        indexes = []
+        base = position * self.words
+        for word in range(self.words):
+            value = self.masks[base + word]
+            while value:
+                low_bit = value & -value
+                indexes.append(word * 64 + low_bit.bit_length() - 1)
+                value ^= low_bit
+        return indexes
+
+
+class RoleSnapshotStore:
+    """
+    Хранит снимок ролей сервера в SQLite на время пересоздания ролей: массивы `array('Q')`
+    пишутся как есть, в виде BLOB, а названия ролей - в JSON. Запись удаляется после возврата ролей.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_DB_PATH):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS role_snapshots ("
+                "guild_id INTEGER PRIMARY KEY, role_names TEXT, member_ids BLOB, masks BLOB, created_at REAL)"
+            )
+
+    def save(self, guild_id: int, snapshot: RoleSnapshot):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO role_snapshots (guild_id, role_names, member_ids, masks, created_at) VALUES (?, ?, ?, ?, ?)",
+                (guild_id, json.dumps(snapshot.role_names, ensure_ascii=False),
+                 snapshot.member_ids.tobytes(), snapshot.masks.tobytes(), time.time())
+            )
+
+    def load(self, guild_id: int) -> Optional[RoleSnapshot]:
+        """Возвращает незавершенный снимок сервера или None."""
+        row = self.conn.execute(
+            "SELECT role_names, member_ids, masks FROM role_snapshots WHERE guild_id = ?", (guild_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        role_names, member_ids, masks = row
+        snapshot = RoleSnapshot(json.loads(role_names))
+        snapshot.member_ids.frombytes(member_ids)
+        snapshot.masks.frombytes(masks)
+        return snapshot
+
+    def forget(self, guild_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM role_snapshots WHERE guild_id = ?", (guild_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class SetupProgress:
+    """
+    Живой прогресс настройки в одном сообщении: вместо отдельного followup на каждый этап
+    исходный ответ на команду редактируется при смене этапа или заметном продвижении.
+    Без `ctx` ничего не отправляет, поэтому методы настройки могут вызывать его всегда.
+    """
+
+    def __init__(self, ctx: Optional[discord.ApplicationContext] = None, title: str = ""):
+        self.ctx = ctx
+        self.title = title
+        self.stages: Dict[str, List[Any]] = {}  # ключ -> [название, выполнено, всего]
+        self.current: Optional[str] = None
+        self.started_at = time.monotonic()
+        self.calls: deque = deque()
+        self.total_calls = 0
+        # Исходный ответ только что отправлен, первое редактирование - не раньше PROGRESS_EDIT_INTERVAL
+        self.last_edit = self.started_at
+        self.last_signature: Optional[Tuple[Optional[str], int]] = None
+        self.editing = False
+        self.token_dead = False
+
+    @property
+    def token_expired(self) -> bool:
+        """True, если токен взаимодействия истек (или вот-вот истечет) и ответ больше нельзя менять."""
+        return self.token_dead or time.monotonic() - self.started_at > INTERACTION_TOKEN_TTL
+
+    def stage(self, key: str, name: str):
+        """Начинает новый этап (или возвращается к уже объявленному)."""
+        self.stages.setdefault(key, [name, 0, 0])
+        self.current = key
+
+    def declare(self, key: str, name: str, total: int):
+        """Объявляет будущий этап с оценкой числа запросов, чтобы ETA учитывал его заранее."""
+        self.stages.setdefault(key, [name, 0, 0])[2] = total
+
+    def add_total(self, count: int):
+        """Добавляет ожидаемое количество запросов к текущему этапу."""
+        if self.current:
+            self.stages[self.current][2] += count
+
+    def set_total(self, count: int):
+        """Задает точное количество запросов текущего этапа, заменяя оценку."""
+        if self.current:
+            self.stages[self.current][2] = self.stages[self.current][1] + count
+
+    async def tick(self, count: int = 1):
+        """Отмечает выполненные запросы к API и при необходимости обновляет сообщение."""
+        now = time.monotonic()
+        if self.current:
+            self.stages[self.current][1] += count
+        self.total_calls += count
+        for _ in range(count):
+            self.calls.append(now)
+        await self.refresh()
+
+    def signature(self) -> Tuple[Optional[str], int]:
+        """Текущий этап и пройденная им ступень в PROGRESS_STEP_PERCENT процентов."""
+        if not self.current:
+            return (None, 0)
+        _, done, total = self.stages[self.current]
+        # Завершение этапа совпадает с началом следующего, отдельной ступенью его не считаем
+        percent = min(100 * done // total, 99) if total else 0
+        return (self.current, percent // PROGRESS_STEP_PERCENT)
+
+    async def refresh(self, force: bool = False):
+        """Редактирует сообщение, если прогресс заметно изменился с прошлого редактирования."""
+        if not self.ctx or self.editing or self.token_expired:
+            return
+        since_edit = time.monotonic() - self.last_edit
+        signature = self.signature()
+        if not force:
+            if since_edit < PROGRESS_EDIT_INTERVAL:
+                return
+            if signature == self.last_signature and since_edit < PROGRESS_HEARTBEAT_INTERVAL:
+                return
+        self.editing = True
+        try:
+            await self.ctx.edit(content=self.render())
+        except (discord.NotFound, discord.Forbidden) as e:
+            # Токен больше недействителен - дальнейшие попытки бесполезны
+            self.token_dead = True
+            print(f"Сообщение с прогрессом больше нельзя обновлять: {e}")
+        except discord.HTTPException as e:
+            print(f"Не удалось обновить сообщение с прогрессом: {e}")
+        finally:
+            self.last_edit = time.monotonic()
+            self.last_signature = signature
+            self.editing = False
+
+    def rate(self) -> float:
+        """Текущая скорость запросов (в секунду) за последние PROGRESS_RATE_WINDOW секунд."""
+        now = time.monotonic()
+        while self.calls and now - self.calls[0] > PROGRESS_RATE_WINDOW:
+            self.calls.popleft()
+        window = max(min(PROGRESS_RATE_WINDOW, now - self.started_at), PROGRESS_RATE_MIN_WINDOW)
+        return len(self.calls) / window
+
+    def render(self) -> str:
+        """Собирает текст сообщения с прогрессом."""
+        lines = [self.title] if self.title else []
+        remaining = 0
+        for key, (name, done, total) in self.stages.items():
+            total = max(total, done)
+            remaining += total - done
+            if total and done >= total:
+                icon = "✅"
+            else:
+                icon = "⏳" if key == self.current else "▫️"
+            lines.append(f"{icon} {name}: **{done}/{total}**")
+
+        elapsed = max(time.monotonic() - self.started_at, PROGRESS_RATE_MIN_WINDOW)
+        # ETA считаем по средней пропускной способности за весь запуск, она устойчивее мгновенной
+        throughput = self.total_calls / elapsed
+        eta = f"≈ {int(remaining / throughput)} с" if throughput > 0 and remaining else "—"
+        if self.stages:
+            lines.append(f"📡 {self.rate():.1f} запр/с · осталось {eta}")
+        return "\n".join(lines)
+
 
 class ServerSetup(commands.Cog):
     """Модуль для полной настройки сервера."""
     
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # Проверенная структура каналов; подменяется целиком в /reload-config и /update-local-structure
+        self.structure: Optional[Dict] = None
+        # Текущие запуски по ключу (операция, ID сервера) и очередь операций на каждом сервере
+        self._inflight: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._guild_locks: Dict[int, asyncio.Lock] = {}
+        self.snapshots = RoleSnapshotStore()
+
+    def cog_unload(self):
+        """Вызывается при выгрузке кога, закрывает базу снимков."""
+        self.snapshots.close()
 
     @discord.slash_command(
         name="setup-server",
@@ -34,41 +392,42 @@ class ServerSetup(commands.Cog):
             return
 
         guild = ctx.guild
-        STRUCTURE_FILE_PATH = "main_server_structure.json"
 
-        if not os.path.exists(STRUCTURE_FILE_PATH):
+        if self.structure is None and not os.path.exists(STRUCTURE_FILE_PATH):
             await ctx.followup.send(
                 "❌ Локальная копия структуры не найдена (`main_server_structure.json`).\n"
                 "Пожалуйста, сначала выполните команду `/update-local-structure`.",
                 ephemeral=True
             )
             return
+
+        # Структуру читаем до начала работы, чтобы не пересоздать роли и упасть на битом файле
+        if self.structure is None:
+            try:
+                self.structure = load_structure()
+            except Exception as e:
+                await ctx.followup.send(f"❌ Не удалось прочитать файл `{STRUCTURE_FILE_PATH}`. Ошибка: {e}", ephemeral=True)
+                return
+        structure = self.structure
         
-        # --- Этап 1: Роли ---
-        await ctx.followup.send("Этап 1: Настройка ролей...", ephemeral=True)
-        roles_result = await self._setup_roles(guild)
-        await ctx.followup.send("Этап 1: Настройка ролей... ✅ Готово!", ephemeral=True)
-        
-        # --- Этап 2: Загрузка и применение структуры каналов ---
-        await ctx.followup.send(f"Этап 2: Загрузка структуры из `{STRUCTURE_FILE_PATH}`...", ephemeral=True)
-        
-        try:
-            with open(STRUCTURE_FILE_PATH, 'r', encoding='utf-8') as f:
-                structure = json.load(f)
-        except Exception as e:
-            await ctx.followup.send(f"❌ Не удалось прочитать файл `{STRUCTURE_FILE_PATH}`. Ошибка: {e}", ephemeral=True)
-            return
-            
-        sync_channels_result = await self._apply_guild_structure(guild, structure)
-        await ctx.followup.send("Этап 2: Применение структуры каналов... ✅ Готово!", ephemeral=True)
+        # Весь прогресс показывается в исходном ответе, который редактируется по ходу работы
+        progress = SetupProgress(ctx, "🚀 Полная настройка сервера")
+        (roles_result, sync_channels_result), attached = await self._single_flight(
+            'setup-server', guild.id, ctx, lambda: self._run_setup(guild, structure, progress), progress
+        )
+        if attached:
+            # Прогресс рисовал чужой запуск; в своем ответе показываем только итог
+            progress.title = "🚀 Полная настройка сервера выполнена другим запуском"
         
         # --- Финальный отчет ---
         roles_report = (f"Создано: **{roles_result.get('created', 0)}**, "
                         f"Обновлено: **{roles_result.get('updated', 0)}**, "
-                        f"Удалено лишних: **{roles_result.get('deleted', 0)}**")
+                        f"Удалено лишних: **{roles_result.get('deleted', 0)}**\n"
+                        f"Роли возвращены участникам: **{roles_result.get('restored', 0)}**")
         
         channels_report = (f"Категорий создано/удалено: **{sync_channels_result.get('cats_created', 0)}/{sync_channels_result.get('cats_deleted', 0)}**\n"
-                           f"Каналов создано/удалено: **{sync_channels_result.get('chans_created', 0)}/{sync_channels_result.get('chans_deleted', 0)}**")
+                           f"Каналов создано/удалено: **{sync_channels_result.get('chans_created', 0)}/{sync_channels_result.get('chans_deleted', 0)}**\n"
+                           f"Права обновлены: **{sync_channels_result.get('overwrites_updated', 0)}**")
 
         final_embed = discord.Embed(title="✅ Синхронизация сервера завершена", color=discord.Color.green())
         final_embed.add_field(name="🎖️ Роли", value=roles_report, inline=False)
@@ -79,12 +438,122 @@ class ServerSetup(commands.Cog):
         
         try:
             await ctx.author.send(embed=final_embed)
-            await ctx.followup.send("✅ Отчет о настройке отправлен вам в личные сообщения.", ephemeral=True)
+            progress.title += "\n✅ Отчет о настройке отправлен вам в личные сообщения."
+            await progress.refresh(force=True)
+            return
         except discord.Forbidden:
-            await ctx.followup.send("⚠️ Не смог отправить отчет в ЛС. Пожалуйста, проверьте настройки приватности. Вот отчет:", embed=final_embed, ephemeral=True)
+            pass
+        except discord.HTTPException as e:
+            print(f"ℹ️ Не удалось отправить отчет в ЛС. Ошибка: {e}")
+
+        await progress.refresh(force=True)
+        try:
+            if not progress.token_expired:
+                await ctx.followup.send("⚠️ Не смог отправить отчет в ЛС. Пожалуйста, проверьте настройки приватности. Вот отчет:", embed=final_embed, ephemeral=True)
+            else:
+                # Токен взаимодействия истек за время долгой настройки - пишем в канал команды
+                await ctx.channel.send(f"{ctx.author.mention} ⚠️ Не смог отправить отчет о настройке в ЛС. Вот отчет:", embed=final_embed)
         except discord.HTTPException as e:
             print(f"ℹ️ Не удалось отправить финальное сообщение в канал, возможно он был удален. Ошибка: {e}")
 
+    async def _run_setup(self, guild: discord.Guild, structure: Dict, progress: SetupProgress) -> Tuple[Dict, Dict]:
+        """Сама работа /setup-server: роли, затем каналы. Выполняется не более одного раза на сервер одновременно."""
+        # Весь запуск работает с одним и тем же конфигом, даже если его перезагрузят посередине
+        config = roles_config
+        # --- Этап 1: Роли ---
+        progress.stage('roles', "Этап 1: Роли")
+        # Этап 2 объявляем сразу с оценкой по текущему состоянию сервера, чтобы ETA учитывал его
+        # уже во время этапа 1. Точный план считается после пересоздания ролей.
+        staff_roles = await self._get_staff_roles(guild, config)
+        estimate = self._plan_guild_structure(guild, structure, staff_roles, config, roles_recreated=True)['total']
+        progress.declare('channels', f"Этап 2: Каналы из `{STRUCTURE_FILE_PATH}`", estimate)
+        roles_result = await self._setup_roles(guild, progress, config)
+        
+        # --- Этап 2: Применение структуры каналов ---
+        progress.stage('channels', f"Этап 2: Каналы из `{STRUCTURE_FILE_PATH}`")
+        sync_channels_result = await self._apply_guild_structure(guild, structure, progress, config)
+        return roles_result, sync_channels_result
+
+    # ======================================================================================
+    # Секция: Защита от параллельных запусков
+    # ======================================================================================
+
+    async def _single_flight(self, operation: str, guild_id: int, ctx: discord.ApplicationContext, factory,
+                             progress: Optional[SetupProgress] = None, exclusive: bool = True) -> Tuple[Any, bool]:
+        """
+        Выполняет `factory()` не более одного раза одновременно для пары (операция, сервер).
+        Повторный запрос во время выполнения не запускает новую работу, а дожидается текущей
+        и получает тот же результат. Операции с `exclusive=True` (меняющие сервер) на одном
+        сервере идут строго по очереди; остальные в эту очередь не встают.
+        Возвращает (результат, присоединились_ли_к_чужому_запуску). Присоединившийся может ждать
+        дольше жизни своего токена, поэтому итог ему нужно отправлять через `_send_late`.
+        """
+        key = (operation, guild_id)
+        running = self._inflight.get(key)
+        if running:
+            info = running['info']
+            try:
+                await ctx.followup.send(
+                    f"⏳ `/{operation}` на этом сервере уже выполняется (запустил {info['author']}). "
+                    "Дождусь его и покажу тот же результат.",
+                    ephemeral=True
+                )
+            except discord.HTTPException as e:
+                print(f"ℹ️ Не удалось сообщить о текущем запуске /{operation}: {e}")
+            # shield: отмена ожидающей команды не должна прерывать чужой запуск
+            return await asyncio.shield(running['task']), True
+
+        lock = self._guild_locks.setdefault(guild_id, asyncio.Lock()) if exclusive else None
+
+        async def run():
+            # Вся работа запуска идет в массовой полосе и не задерживает ответы на команды
+            with priority(LANE_BULK):
+                if lock is None:
+                    return await factory()
+                async with lock:
+                    info['state'] = "выполняется"
+                    return await factory()
+
+        info = {'author': str(ctx.author), 'started_at': time.monotonic(), 'progress': progress,
+                'state': "ждет другую операцию" if lock and lock.locked() else "выполняется"}
+        task = asyncio.create_task(run())
+        self._inflight[key] = {'task': task, 'info': info}
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task), False
+
+    async def _send_late(self, ctx: discord.ApplicationContext, started_at: float, message: str):
+        """Отправляет итог команды: followup, пока токен взаимодействия жив, иначе - в канал команды."""
+        try:
+            if time.monotonic() - started_at <= INTERACTION_TOKEN_TTL:
+                await ctx.followup.send(message, ephemeral=True)
+            else:
+                await ctx.channel.send(f"{ctx.author.mention} {message}")
+        except discord.HTTPException as e:
+            print(f"ℹ️ Не удалось отправить итог команды, возможно канал был удален. Ошибка: {e}")
+
+    @discord.slash_command(
+        name="setup-status",
+        description="Показывает, какие операции настройки сейчас выполняются на этом сервере."
+    )
+    @commands.has_permissions(administrator=True)
+    async def setup_status(self, ctx: discord.ApplicationContext):
+        """Показывает текущие запуски /setup-server и /update-local-structure на сервере."""
+        if not ctx.guild:
+            await ctx.respond("❌ Команда должна выполняться на сервере.", ephemeral=True)
+            return
+
+        lines = []
+        for (operation, guild_id), running in self._inflight.items():
+            if guild_id != ctx.guild.id:
+                continue
+            info = running['info']
+            elapsed = int(time.monotonic() - info['started_at'])
+            lines.append(f"**/{operation}** — {info['state']}, запустил {info['author']}, идет {elapsed} с")
+            if info['progress'] and info['progress'].stages:
+                lines.append(info['progress'].render())
+
+        await ctx.respond("\n".join(lines) or "✅ Сейчас на этом сервере ничего не выполняется.", ephemeral=True)
+
     # ======================================================================================
     # Секция: Вспомогательные методы для работы со структурой
     # ======================================================================================
@@ -96,10 +565,10 @@ class ServerSetup(commands.Cog):
     @commands.has_permissions(administrator=True)
     async def update_local_structure(self, ctx: discord.ApplicationContext):
         """Скачивает и сохраняет структуру с главного сервера."""
+        started_at = time.monotonic()
         await ctx.defer(ephemeral=True)
 
         SOURCE_GUILD_ID = 1369754088941682830
-        STRUCTURE_FILE_PATH = "main_server_structure.json"
 
         source_guild = self.bot.get_guild(SOURCE_GUILD_ID)
         if not source_guild:
@@ -111,15 +580,63 @@ class ServerSetup(commands.Cog):
             return
         
         await ctx.followup.send(f"✅ Начинаю сканирование сервера **{source_guild.name}**...", ephemeral=True)
-        
-        structure = self._get_guild_structure(source_guild)
-        
+
+        async def run() -> str:
+            structure = self._get_guild_structure(source_guild)
+            try:
+                # Пишем во временный файл и атомарно подменяем, чтобы параллельное чтение не увидело половину файла
+                temp_path = f"{STRUCTURE_FILE_PATH}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(structure, f, ensure_ascii=False, indent=4)
+                os.replace(temp_path, STRUCTURE_FILE_PATH)
+                self.structure = structure
+                return f"✅ Структура каналов успешно сохранена в файл `{STRUCTURE_FILE_PATH}`."
+            except Exception as e:
+                return f"❌ Не удалось сохранить файл. Ошибка: {e}"
+
+        # Запуск привязан к серверу, где вызвали команду: там его видно в /setup-status.
+        # Сервер команда не меняет, а файл подменяется атомарно, поэтому в очередь за
+        # многочасовым /setup-server она не встает.
+        guild_id = ctx.guild.id if ctx.guild else source_guild.id
+        message, _ = await self._single_flight('update-local-structure', guild_id, ctx, run, exclusive=False)
+        await self._send_late(ctx, started_at, message)
+
+    @discord.slash_command(
+        name="reload-config",
+        description="Перечитывает roles_config.py и файл структуры без перезапуска бота."
+    )
+    @commands.has_permissions(administrator=True)
+    async def reload_config(self, ctx: discord.ApplicationContext):
+        """Загружает, проверяет и атомарно подменяет конфиг ролей/прав и структуру каналов."""
+        await ctx.defer(ephemeral=True)
+
+        # Подмена конфига посреди настройки перепутала бы роли, поэтому во время запусков отказываем.
+        # Проверка и подмена ниже идут без await, так что новый запуск между ними не вклинится.
+        if self._inflight:
+            running = ", ".join(f"`/{operation}`" for operation, _ in self._inflight)
+            await ctx.followup.send(f"⏳ Сейчас выполняется {running}. Повторите `/reload-config` после завершения.", ephemeral=True)
+            return
+
+        # Сначала загружаем и проверяем оба источника, подменяем только если оба в порядке
         try:
-            with open(STRUCTURE_FILE_PATH, 'w', encoding='utf-8') as f:
-                json.dump(structure, f, ensure_ascii=False, indent=4)
-            await ctx.followup.send(f"✅ Структура каналов успешно сохранена в файл `{STRUCTURE_FILE_PATH}`.", ephemeral=True)
+            structure = load_structure() if os.path.exists(STRUCTURE_FILE_PATH) else None
         except Exception as e:
-            await ctx.followup.send(f"❌ Не удалось сохранить файл. Ошибка: {e}", ephemeral=True)
+            await ctx.followup.send(f"❌ Файл `{STRUCTURE_FILE_PATH}` не прошел проверку, ничего не изменено. Ошибка: {e}", ephemeral=True)
+            return
+
+        try:
+            module = reload_config_module()
+        except Exception as e:
+            await ctx.followup.send(f"❌ `roles_config.py` не прошел проверку, ничего не изменено. Ошибка: {e}", ephemeral=True)
+            return
+
+        self.structure = structure
+        categories = len(structure['categories']) if structure else 0
+        await ctx.followup.send(
+            f"✅ Конфиг перезагружен: ролей **{len(module.ROLES_STRUCTURE)}**, "
+            f"схем прав **{len(module.CHANNEL_PERMISSIONS)}**, категорий в структуре **{categories}**.",
+            ephemeral=True
+        )
 
     def _get_guild_structure(self, guild: discord.Guild) -> Dict:
         """Собирает структуру каналов и категорий сервера в словарь."""
@@ -152,73 +669,135 @@ class ServerSetup(commands.Cog):
             })
         return structure
 
-    async def _apply_guild_structure(self, guild: discord.Guild, server_structure: Dict) -> Dict:
+    def _plan_guild_structure(self, guild: discord.Guild, server_structure: Dict, staff_roles: Dict[str, discord.Role], config, roles_recreated: bool = False) -> Dict:
+        """
+        Заранее собирает все изменения каналов и категорий, чтобы прогресс знал полный объем работы.
+        Число перестановок - оценка: позиции новых каналов известны только после их создания.
+        С `roles_recreated=True` план считается до пересоздания ролей: оверрайты старых ролей
+        пропадут вместе с ними, поэтому все цели из конфига считаются отличающимися.
+        """
+        categories = server_structure.get('categories', [])
+        config_cat_map = {cat['name']: cat for cat in categories}
+        config_all_chan_names = {chan['name'] for cat_data in categories for chan_type in ['text', 'voice'] for chan in cat_data.get('channels', {}).get(chan_type, [])}
+        server_cats_map = {cat.name: cat for cat in guild.categories}
+        managed_targets = list(staff_roles.values())
+
+        plan = {
+            'cats_to_delete': [(cat_name, category) for cat_name, category in server_cats_map.items() if cat_name not in config_cat_map],
+            'cats_to_create': [cat_name for cat_name in config_cat_map if cat_name and cat_name not in server_cats_map],
+            'chans_to_delete': [c for c in guild.channels if not isinstance(c, discord.CategoryChannel)
+                                and c.name not in config_all_chan_names and c.name not in config.PROTECTED_CHANNELS],
+            'chans_to_create': [],  # (название категории, тип, название канала)
+            'overwrites': [],       # (канал или категория, {цель: оверрайт или None})
+            'positions': 0,
+        }
+
+        # Уже существующим категориям обновляем только отличающиеся права
+        for cat_name, cat_data in config_cat_map.items():
+            if cat_name and cat_name in server_cats_map:
+                desired = self._get_overwrites(cat_name, 'category', staff_roles, config=config)
+                if desired:
+                    changes = dict(desired) if roles_recreated else self._diff_overwrites(server_cats_map[cat_name].overwrites, desired, managed_targets)
+                    if changes:
+                        plan['overwrites'].append((server_cats_map[cat_name], changes))
+
+        category_moves = bool(plan['cats_to_delete'] or plan['cats_to_create'])
+        for position, cat_data in enumerate(cat for cat in categories if cat.get('name')):
+            category_obj = server_cats_map.get(cat_data['name'])
+            if category_obj and category_obj.position != position:
+                category_moves = True
+        plan['positions'] += 1 if category_moves else 0
+
+        for cat_data in categories:
+            cat_name = cat_data.get('name')
+            category_obj = server_cats_map.get(cat_name)
+            if category_obj: existing_chans_in_cat = {c.name: c for c in category_obj.channels}
+            elif cat_name: existing_chans_in_cat = {}
+            else: existing_chans_in_cat = {c.name: c for c in guild.channels if c.category is None and not isinstance(c, discord.CategoryChannel)}
+
+            all_chans_in_cat_config = [(chan_type, chan_info['name']) for chan_type in ['text', 'voice'] for chan_info in cat_data.get('channels', {}).get(chan_type, [])]
+            for i, (chan_type, chan_name) in enumerate(all_chans_in_cat_config):
+                chan_obj = existing_chans_in_cat.get(chan_name)
+                if chan_obj is None:
+                    plan['chans_to_create'].append((cat_name, chan_type, chan_name))
+                    if cat_name:
+                        plan['positions'] += 1
+                    continue
+                desired = self._get_overwrites(chan_name, 'channel', staff_roles, inherited_from=cat_name, config=config)
+                if desired:
+                    changes = dict(desired) if roles_recreated else self._diff_overwrites(chan_obj.overwrites, desired, managed_targets)
+                    if changes:
+                        plan['overwrites'].append((chan_obj, changes))
+                if cat_name and chan_obj.position != i:
+                    plan['positions'] += 1
+
+        plan['total'] = (len(plan['cats_to_delete']) + len(plan['cats_to_create']) + len(plan['chans_to_delete'])
+                         + len(plan['chans_to_create']) + sum(len(changes) for _, changes in plan['overwrites'])
+                         + plan['positions'])
+        return plan
+
+    async def _apply_guild_structure(self, guild: discord.Guild, server_structure: Dict, progress: Optional[SetupProgress] = None, config=None) -> Dict:
         """Синхронизирует каналы и категории на сервере, вместо полного удаления."""
-        results = {'cats_created': 0, 'cats_deleted': 0, 'chans_created': 0, 'chans_deleted': 0, 'errors': 0}
-        protected_channels = roles_config.PROTECTED_CHANNELS
+        results = {'cats_created': 0, 'cats_deleted': 0, 'chans_created': 0, 'chans_deleted': 0, 'overwrites_updated': 0, 'errors': 0}
+        progress = progress or SetupProgress()
+        config = config or roles_config
 
         # --- 0. Получаем актуальные роли персонала ---
-        staff_roles = await self._get_staff_roles(guild)
+        staff_roles = await self._get_staff_roles(guild, config)
 
-        # --- 1. Сбор информации ---
-        config_cat_map = {cat['name']: cat for cat in server_structure.get('categories', [])}
-        config_all_chan_names = {chan['name'] for cat_data in server_structure.get('categories', []) for chan_type in ['text', 'voice'] for chan in cat_data.get('channels', {}).get(chan_type, [])}
+        # --- 1. План всех изменений ---
+        plan = self._plan_guild_structure(guild, server_structure, staff_roles, config)
+        progress.set_total(plan['total'])
         server_cats_map = {cat.name: cat for cat in guild.categories}
 
         # --- 2. Синхронизация Категорий (Удаление и Создание) ---
-        for cat_name, category in list(server_cats_map.items()):
-            if cat_name not in config_cat_map:
-                try:
-                    await category.delete(reason="Синхронизация: удаление лишней категории")
-                    results['cats_deleted'] += 1
-                    del server_cats_map[cat_name]
-                except Exception as e: results['errors'] += 1; print(f"Ошибка удаления категории {cat_name}: {e}")
+        for cat_name, category in plan['cats_to_delete']:
+            try:
+                await category.delete(reason="Синхронизация: удаление лишней категории")
+                results['cats_deleted'] += 1
+                del server_cats_map[cat_name]
+            except Exception as e: results['errors'] += 1; print(f"Ошибка удаления категории {cat_name}: {e}")
+            await progress.tick()
         
-        for cat_name in config_cat_map:
-            if cat_name and cat_name not in server_cats_map:
-                try:
-                    overwrites = self._get_overwrites(cat_name, 'category', staff_roles)
-                    new_cat = await guild.create_category(name=cat_name, overwrites=overwrites, reason="Синхронизация: создание категории")
-                    server_cats_map[cat_name] = new_cat
-                    results['cats_created'] += 1
-                except Exception as e: results['errors'] += 1; print(f"Ошибка создания категории {cat_name}: {e}")
+        for cat_name in plan['cats_to_create']:
+            try:
+                overwrites = self._get_overwrites(cat_name, 'category', staff_roles, config=config)
+                new_cat = await guild.create_category(name=cat_name, overwrites=overwrites, reason="Синхронизация: создание категории")
+                server_cats_map[cat_name] = new_cat
+                results['cats_created'] += 1
+            except Exception as e: results['errors'] += 1; print(f"Ошибка создания категории {cat_name}: {e}")
+            await progress.tick()
         
         await asyncio.sleep(1)
 
         # --- 3. Синхронизация Каналов (Удаление и Создание) ---
-        server_all_chans = [c for c in guild.channels if not isinstance(c, discord.CategoryChannel)]
-        for chan in server_all_chans:
-            if chan.name not in config_all_chan_names and chan.name not in protected_channels:
-                try:
-                    await chan.delete(reason="Синхронизация: удаление лишнего канала")
-                    results['chans_deleted'] += 1
-                except Exception as e: results['errors'] += 1; print(f"Ошибка удаления канала {chan.name}: {e}")
+        for chan in plan['chans_to_delete']:
+            try:
+                await chan.delete(reason="Синхронизация: удаление лишнего канала")
+                results['chans_deleted'] += 1
+            except Exception as e: results['errors'] += 1; print(f"Ошибка удаления канала {chan.name}: {e}")
+            await progress.tick()
 
         await asyncio.sleep(1)
 
-        for cat_data in server_structure.get('categories', []):
-            cat_name = cat_data.get('name')
+        for cat_name, chan_type, chan_name in plan['chans_to_create']:
             category_obj = server_cats_map.get(cat_name)
-            
-            # Определяем, где искать существующие каналы
-            if category_obj: existing_chans_in_cat = {c.name for c in category_obj.channels}
-            else: existing_chans_in_cat = {c.name for c in guild.channels if c.category is None and not isinstance(c, discord.CategoryChannel)}
-
-            for chan_type in ['text', 'voice']:
-                for chan_info in cat_data.get('channels', {}).get(chan_type, []):
-                    chan_name = chan_info['name']
-                    if chan_name not in existing_chans_in_cat:
-                        creator = guild.create_text_channel if chan_type == 'text' else guild.create_voice_channel
-                        try:
-                            overwrites = self._get_overwrites(chan_name, 'channel', staff_roles, inherited_from=cat_name)
-                            await creator(name=chan_name, category=category_obj, overwrites=overwrites, reason="Синхронизация: создание канала")
-                            results['chans_created'] += 1
-                            await asyncio.sleep(0.2)
-                        except Exception as e: results['errors'] += 1; print(f"Ошибка создания канала {chan_name}: {e}")
+            creator = guild.create_text_channel if chan_type == 'text' else guild.create_voice_channel
+            try:
+                overwrites = self._get_overwrites(chan_name, 'channel', staff_roles, inherited_from=cat_name, config=config)
+                await creator(name=chan_name, category=category_obj, overwrites=overwrites, reason="Синхронизация: создание канала")
+                results['chans_created'] += 1
+                await asyncio.sleep(0.2)
+            except Exception as e: results['errors'] += 1; print(f"Ошибка создания канала {chan_name}: {e}")
+            await progress.tick()
+
+        # --- 4. Права существующих каналов и категорий: только отличающиеся цели ---
+        for channel, changes in plan['overwrites']:
+            await self._sync_overwrites(channel, changes, results, progress)
         
         await asyncio.sleep(2)
 
-        # --- 4. Финальная сортировка ---
+        # --- 5. Финальная сортировка ---
         # Собираем ОДИН большой payload для ОДНОГО вызова API
         final_position_payload = {}
         position_counter = 0
@@ -232,19 +811,21 @@ class ServerSetup(commands.Cog):
                     if category_obj.position != position_counter:
                         final_position_payload[category_obj] = position_counter
                     position_counter += 1
-        
+
+        category_moves = 1 if final_position_payload else 0
         if final_position_payload:
             await guild.edit_channel_positions(positions=final_position_payload)
+            await progress.tick()
             await asyncio.sleep(1)
-        
+
         # Затем каналы внутри категорий
+        # Каналы должны быть отсортированы внутри своей категории
+        # С discord.py v2+ это делается через channel.edit(position=...)
+        # или guild.edit_channel_positions с позициями относительно категории, что сложно.
+        # Попробуем более простой и надежный способ - индивидуальное перемещение.
+        channel_moves = []
         for cat_data in server_structure.get('categories', []):
             category_obj = discord.utils.get(guild.categories, name=cat_data.get('name'))
-            # Каналы должны быть отсортированы внутри своей категории
-            # С discord.py v2+ это делается через channel.edit(position=...)
-            # или guild.edit_channel_positions с позициями относительно категории, что сложно.
-            # Попробуем более простой и надежный способ - индивидуальное перемещение.
-            
             all_chans_in_cat_config = cat_data.get('channels', {}).get('text', []) + cat_data.get('channels', {}).get('voice', [])
             
             if category_obj: # Обрабатываем каналы внутри реальной категории
@@ -252,40 +833,83 @@ class ServerSetup(commands.Cog):
                 for i, chan_info in enumerate(all_chans_in_cat_config):
                     chan_obj = server_chans_in_cat.get(chan_info['name'])
                     if chan_obj and chan_obj.position != i:
-                        try:
-                            # Для каналов внутри категорий их позиция относительна
-                            await chan_obj.edit(position=i, reason="Синхронизация: сортировка каналов")
-                        except Exception as e:
-                            results['errors'] += 1; print(f"Ошибка сортировки канала {chan_obj.name}: {e}")
+                        channel_moves.append((chan_obj, i))
+
+        # Оценку перестановок из плана заменяем фактическим числом
+        progress.add_total(category_moves + len(channel_moves) - plan['positions'])
+
+        for chan_obj, i in channel_moves:
+            try:
+                # Для каналов внутри категорий их позиция относительна
+                await chan_obj.edit(position=i, reason="Синхронизация: сортировка каналов")
+            except Exception as e:
+                results['errors'] += 1; print(f"Ошибка сортировки канала {chan_obj.name}: {e}")
+            await progress.tick()
 
         return results
 
-    async def _setup_roles(self, guild: discord.Guild) -> Dict:
+    async def _setup_roles(self, guild: discord.Guild, progress: Optional[SetupProgress] = None, config=None) -> Dict:
         """Полностью пересоздает роли согласно конфигу для идеальной иерархии."""
-        results = {'created': 0, 'deleted': 0, 'errors': 0}
+        results = {'created': 0, 'deleted': 0, 'restored': 0, 'errors': 0}
+        progress = progress or SetupProgress()
+        config = config or roles_config
+
+        # --- 0. Снимок выданных ролей, чтобы вернуть их участникам после пересоздания ---
+        # Снимок берется из кеша участников: без полного кеша роли не попавших в него участников
+        # пропадут безвозвратно, поэтому без него роли не трогаем вовсе.
+        if not guild.chunked:
+            try:
+                await guild.chunk()
+            except Exception as e:
+                print(f"Ошибка загрузки участников сервера {guild.name}: {e}")
+        if not guild.chunked:
+            results['errors'] += 1
+            print(f"Сервер {guild.name}: кеш участников неполный, пересоздание ролей отменено.")
+            return results
+
+        # Незавершенный снимок значит, что прошлая настройка оборвалась после удаления ролей:
+        # у участников их уже нет, поэтому возвращаем роли по сохраненному снимку, а не снимаем новый.
+        snapshot = self.snapshots.load(guild.id)
+        if snapshot is not None:
+            print(f"Сервер {guild.name}: найден незавершенный снимок ролей ({len(snapshot)} участников), продолжаю с него.")
+        else:
+            snapshot = RoleSnapshot.capture(guild, config)
+            # Сохраняем до первого удаления: иначе падение бота во время возврата ролей потеряет их все
+            try:
+                self.snapshots.save(guild.id, snapshot)
+            except sqlite3.Error as e:
+                results['errors'] += 1
+                print(f"Сервер {guild.name}: не удалось сохранить снимок ролей, пересоздание ролей отменено: {e}")
+                return results
+        print(f"Снимок ролей сервера {guild.name}: {len(snapshot)} участников, "
+              f"{snapshot.member_ids.itemsize * len(snapshot.member_ids) + snapshot.masks.itemsize * len(snapshot.masks)} байт")
         
         # --- 1. Удаление старых управляемых ролей ---
-        config_role_names = {role['name'] for role in roles_config.ROLES_STRUCTURE}
-        for role in guild.roles:
-            if role.name in config_role_names:
-                try:
-                    await role.delete(reason="Синхронизация: полное пересоздание ролей")
-                    results['deleted'] += 1
-                except discord.HTTPException as e:
-                    results['errors'] += 1
-                    print(f"Ошибка при удалении старой роли {role.name}: {e}")
+        config_role_names = get_compiled_config(config)['role_index']
+        roles_to_delete = [role for role in guild.roles if role.name in config_role_names]
+        # Удаление, создание, иерархия, роль бота и возврат ролей участникам
+        progress.add_total(len(roles_to_delete) + len(config.ROLES_STRUCTURE) + 2 + len(snapshot))
+        for role in roles_to_delete:
+            try:
+                await role.delete(reason="Синхронизация: полное пересоздание ролей")
+                results['deleted'] += 1
+            except discord.HTTPException as e:
+                results['errors'] += 1
+                print(f"Ошибка при удалении старой роли {role.name}: {e}")
+            await progress.tick()
         
         await asyncio.sleep(2) # Пауза после массового удаления
 
         # --- 2. Создание ролей с нуля ---
         created_roles = []
-        for role_data in roles_config.ROLES_STRUCTURE:
+        roles_by_name: Dict[str, discord.Role] = {}
+        for role_data in config.ROLES_STRUCTURE:
             try:
                 role_name = role_data.get("name")
                 if not role_name: continue
 
                 target_props = {
-                    'permissions': role_data.get("permissions", roles_config.P_NO_PERMS),
+                    'permissions': role_data.get("permissions", config.P_NO_PERMS),
                     'color': role_data.get("color", discord.Color.default()),
                     'hoist': role_data.get("hoist", False),
                     'mentionable': role_data.get("mentionable", False)
@@ -293,11 +917,13 @@ class ServerSetup(commands.Cog):
                 
                 new_role = await guild.create_role(name=role_name, **target_props, reason="Синхронизация: создание роли")
                 created_roles.append(new_role)
+                roles_by_name[role_name] = new_role
                 results['created'] += 1
                 await asyncio.sleep(0.3)
             except Exception as e:
                 results['errors'] += 1
                 print(f"Ошибка при создании роли {role_data.get('name')}: {e}")
+            await progress.tick()
 
         # --- 3. Установка правильной иерархии ---
         # Discord API требует, чтобы позиции были от 1.
@@ -309,6 +935,7 @@ class ServerSetup(commands.Cog):
         except Exception as e:
             results['errors'] += 1
             print(f"Ошибка при установке иерархии ролей: {e}")
+        await progress.tick()
 
         # --- 4. Настройка роли самого бота ---
         bot_member = guild.get_member(self.bot.user.id)
@@ -326,25 +953,95 @@ class ServerSetup(commands.Cog):
                 except Exception as e:
                     results['errors'] += 1
                     print(f"Ошибка при настройке роли бота: {e}")
+        await progress.tick()
+
+        # --- 5. Возврат ролей участникам ---
+        restore_result = await self._restore_roles(guild, snapshot, roles_by_name, progress)
+        results['restored'] = restore_result['restored']
+        results['errors'] += restore_result['errors']
+        self.snapshots.forget(guild.id)
 
         return results
 
-    def _get_overwrites(self, name: str, item_type: str, staff_roles: Dict[str, discord.Role], inherited_from: Optional[str] = None) -> Dict:
+    async def _restore_roles(self, guild: discord.Guild, snapshot: RoleSnapshot, roles_by_name: Dict[str, discord.Role], progress: SetupProgress) -> Dict:
+        """Возвращает роли из снимка: один запрос на участника, не более ROLE_RESTORE_CONCURRENCY одновременно."""
+        results = {'restored': 0, 'errors': 0}
+        positions = iter(range(len(snapshot)))
+
+        async def worker():
+            # Воркеры делят один итератор, поэтому задач в памяти всегда не больше ROLE_RESTORE_CONCURRENCY
+            for position in positions:
+                member = guild.get_member(snapshot.member_ids[position])
+                # Сопоставляем по имени: позиции в снимке относятся к конфигу на момент снимка
+                roles = [roles_by_name[snapshot.role_names[i]] for i in snapshot.role_indexes(position) if snapshot.role_names[i] in roles_by_name]
+                if not member or not roles:
+                    # Запрос не понадобился - убираем его из ожидаемых
+                    progress.add_total(-1)
+                    continue
+                try:
+                    # atomic=False склеивает все роли в один PATCH участника
+                    await member.add_roles(*roles, reason="Синхронизация: возврат ролей после пересоздания", atomic=False)
+                    results['restored'] += 1
+                except discord.HTTPException as e:
+                    results['errors'] += 1
+                    print(f"Ошибка при возврате ролей участнику {member}: {e}")
+                await progress.tick()
+
+        await asyncio.gather(*(worker() for _ in range(ROLE_RESTORE_CONCURRENCY)))
+        return results
+
+    @staticmethod
+    def _overwrite_bits(overwrite: Optional[discord.PermissionOverwrite]) -> tuple:
+        """Переводит PermissionOverwrite в пару битовых полей (allow, deny)."""
+        if overwrite is None:
+            return (0, 0)
+        allow, deny = overwrite.pair()
+        return (allow.value, deny.value)
+
+    def _diff_overwrites(self, current: Dict, desired: Dict, managed_targets: List) -> Dict:
+        """
+        Сравнивает текущие права с конфигом по битовым полям allow/deny.
+        Возвращает только отличающиеся цели управляемых ролей; None означает удаление оверрайта.
+        """
+        changes = {}
+        for target in managed_targets:
+            desired_bits = self._overwrite_bits(desired.get(target))
+            if self._overwrite_bits(current.get(target)) != desired_bits:
+                changes[target] = desired.get(target) if desired_bits != (0, 0) else None
+        return changes
+
+    async def _sync_overwrites(self, channel: discord.abc.GuildChannel, changes: Dict, results: Dict, progress: SetupProgress):
+        """Отправляет только отличающиеся цели из `_diff_overwrites`, по одному запросу на цель."""
+        # Весь список оверрайтов не пересылаем, иначе py-cord потеряет оверрайты участников,
+        # которых нет в кеше (channel.overwrites их пропускает)
+        updated = False
+        for target, overwrite in changes.items():
+            try:
+                await channel.set_permissions(target, overwrite=overwrite, reason="Синхронизация: обновление прав доступа")
+                updated = True
+            except Exception as e:
+                results['errors'] += 1; print(f"Ошибка обновления прав {channel.name} для {target}: {e}")
+            await progress.tick()
+        if updated:
+            results['overwrites_updated'] += 1
+
+    def _get_overwrites(self, name: str, item_type: str, staff_roles: Dict[str, discord.Role], inherited_from: Optional[str] = None, config=None) -> Dict:
         """Собирает словарь прав для канала или категории на основе конфига."""
+        config = config or roles_config
         
         permission_key = None
         if item_type == 'category':
-            permission_key = roles_config.CHANNEL_CONFIG['category_map'].get(name)
+            permission_key = config.CHANNEL_CONFIG['category_map'].get(name)
         elif item_type == 'channel':
             # Права канала приоритетнее прав категории
-            permission_key = roles_config.CHANNEL_CONFIG['channel_map'].get(name)
+            permission_key = config.CHANNEL_CONFIG['channel_map'].get(name)
             if not permission_key and inherited_from:
-                permission_key = roles_config.CHANNEL_CONFIG['category_map'].get(inherited_from)
+                permission_key = config.CHANNEL_CONFIG['category_map'].get(inherited_from)
 
         if not permission_key:
             return {}
             
-        permission_data = roles_config.CHANNEL_PERMISSIONS.get(permission_key, {})
+        permission_data = config.CHANNEL_PERMISSIONS.get(permission_key, {})
         overwrites = {}
         
         for role_key, permissions in permission_data.items():
@@ -358,15 +1055,14 @@ class ServerSetup(commands.Cog):
                 overwrites[target] = permissions
         return overwrites
 
-    async def _get_staff_roles(self, guild: discord.Guild) -> Dict[str, discord.Role]:
+    async def _get_staff_roles(self, guild: discord.Guild, config=None) -> Dict[str, discord.Role]:
         """Находит все роли персонала и возвращает их в виде словаря."""
         staff_roles = {'@everyone': guild.default_role}
-        for role_data in roles_config.ROLES_STRUCTURE:
-            if 'role_type' in role_data:
-                # Ищем роль на сервере по имени из конфига
-                role = discord.utils.get(guild.roles, name=role_data['name'])
-                if role:
-                    staff_roles[role_data['role_type']] = role
+        for role_type, role_name in get_compiled_config(config)['staff_role_names'].items():
+            # Ищем роль на сервере по имени из конфига
+            role = discord.utils.get(guild.roles, name=role_name)
+            if role:
+                staff_roles[role_type] = role
         return staff_roles
 
 
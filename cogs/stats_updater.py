@@ -5,17 +5,92 @@
 import discord
 from discord.ext import commands, tasks
 import asyncio
+import hashlib
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+from api_scheduler import LANE_BACKGROUND, priority
 
 # --- КОНФИГУРАЦИЯ ---
 # Как часто (в минутах) обновлять статистику. 
 # Не ставьте слишком низкое значение, чтобы не получить бан от Discord. 10 - оптимально.
 UPDATE_INTERVAL_MINUTES = 10
 
+# Discord разрешает переименовать канал 2 раза за 10 минут. Чаще одного раза
+# в этот интервал (в секундах) один канал не переименовываем, в том числе между перезапусками.
+RENAME_COOLDOWN_SECONDS = 5 * 60
+
 # Префиксы каналов, которые бот будет искать для обновления.
 # Важно, чтобы они в точности совпадали с названиями в файле структуры.
 MEMBER_CHANNEL_PREFIX = "╔ 📚・Участники:"
 BOT_CHANNEL_PREFIX = "╚ 📚・Боты:"
 
+# Локальная база, в которой статистика переживает перезапуск бота.
+STATE_DB_PATH = "bot_state.sqlite3"
+
+# После подключения Discord сначала сообщает только ID серверов, а сами серверы присылает
+# по одному. Еще не присланные (и недоступные из-за сбоя) серверы проход откладывает и
+# перепроверяет раз в столько секунд, пока не подойдет время следующего прохода.
+PENDING_RETRY_SECONDS = 5
+
+
+class StateStore:
+    """
+    Небольшое хранилище на SQLite: последние счетчики по серверу, последние
+    опубликованные названия каналов со временем публикации и хеш каналов статистики.
+    Позволяет после перезапуска сразу, до загрузки участников, продолжить с того же места
+    без лишних переименований.
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS guild_stats ("
+                "guild_id INTEGER PRIMARY KEY, member_count INTEGER, bot_count INTEGER, structure_hash TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS published_names ("
+                "channel_id INTEGER PRIMARY KEY, guild_id INTEGER, name TEXT, published_at REAL)"
+            )
+
+    def get_guild(self, guild_id: int) -> Optional[Tuple[int, int, str]]:
+        """Возвращает (участники, боты, хеш каналов) или None."""
+        return self.conn.execute(
+            "SELECT member_count, bot_count, structure_hash FROM guild_stats WHERE guild_id = ?",
+            (guild_id,)
+        ).fetchone()
+
+    def save_guild(self, guild_id: int, member_count: int, bot_count: int, structure_hash: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO guild_stats (guild_id, member_count, bot_count, structure_hash) VALUES (?, ?, ?, ?)",
+                (guild_id, member_count, bot_count, structure_hash)
+            )
+
+    def get_published(self, guild_id: int) -> Dict[int, Tuple[str, float]]:
+        """Возвращает {ID канала: (последнее опубликованное название, время публикации)}."""
+        rows = self.conn.execute(
+            "SELECT channel_id, name, published_at FROM published_names WHERE guild_id = ?", (guild_id,)
+        )
+        return {channel_id: (name, published_at) for channel_id, name, published_at in rows}
+
+    def save_published(self, guild_id: int, channel_id: int, name: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO published_names VALUES (?, ?, ?, ?)",
+                (channel_id, guild_id, name, time.time())
+            )
+
+    def forget_published(self, guild_id: int):
+        """Забывает опубликованные названия сервера (каналы статистики были пересозданы)."""
+        with self.conn:
+            self.conn.execute("DELETE FROM published_names WHERE guild_id = ?", (guild_id,))
+
+    def close(self):
+        self.conn.close()
+
 
 class StatsUpdater(commands.Cog):
     """
@@ -25,11 +100,13 @@ class StatsUpdater(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.store = StateStore()
         self.update_stats_task.start()
 
     def cog_unload(self):
         """Вызывается при выгрузке кога, останавливает задачу."""
         self.update_stats_task.cancel()
+        self.store.close()
 
     @tasks.loop(minutes=UPDATE_INTERVAL_MINUTES)
     async def update_stats_task(self):
@@ -38,21 +115,50 @@ class StatsUpdater(commands.Cog):
         статистики для всех серверов, где находится бот.
         """
         print("Запускаю фоновую задачу обновления статистики каналов...")
-        for guild in self.bot.guilds:
-            try:
-                await self._update_single_guild(guild)
-            except Exception as e:
-                print(f"Критическая ошибка при обновлении статистики для сервера {guild.name} ({guild.id}): {e}")
+        started_at = time.monotonic()
+        # Статистика получает только свободную от команд и настройки пропускную способность
+        with priority(LANE_BACKGROUND):
+            pending = [guild.id for guild in self.bot.guilds if not await self._try_update(guild)]
+            # Отложенные серверы догоняем сразу, как только они приходят, а не через полный интервал
+            while pending and time.monotonic() - started_at < UPDATE_INTERVAL_MINUTES * 60 - PENDING_RETRY_SECONDS:
+                await asyncio.sleep(PENDING_RETRY_SECONDS)
+                still_pending = []
+                for guild_id in pending:
+                    guild = self.bot.get_guild(guild_id)
+                    # Бота убрали с сервера - ждать больше нечего
+                    if guild and not await self._try_update(guild):
+                        still_pending.append(guild_id)
+                pending = still_pending
         print("Задача обновления статистики завершена.")
+
+    async def _try_update(self, guild: discord.Guild) -> bool:
+        """Обновляет сервер, перехватывая ошибки. Возвращает False, если сервер нужно перепроверить позже."""
+        try:
+            return await self._update_single_guild(guild)
+        except Exception as e:
+            print(f"Критическая ошибка при обновлении статистики для сервера {guild.name} ({guild.id}): {e}")
+            return True
     
     @update_stats_task.before_loop
     async def before_update_stats(self):
-        """Ожидает полной готовности бота перед первым запуском задачи."""
-        await self.bot.wait_until_ready()
+        """
+        Ожидает, пока бот получит список серверов. Ни самих серверов, ни загрузки участников
+        не ждет: первый проход обновляет серверы по мере их прихода, а для еще не догруженных
+        берет сохраненные значения.
+        """
+        while not self.bot.guilds and not self.bot.is_ready():
+            await asyncio.sleep(PENDING_RETRY_SECONDS)
         print("Модуль статистики готов к работе. Запускаю цикл обновлений.")
 
-    async def _update_single_guild(self, guild: discord.Guild):
-        """Обновляет статистику для одного конкретного сервера."""
+    async def _update_single_guild(self, guild: discord.Guild) -> bool:
+        """
+        Обновляет статистику для одного конкретного сервера.
+        Возвращает False, если сервер еще не пришел или число ботов пока неизвестно.
+        """
+        # До GUILD_CREATE на месте сервера лежит пустая заглушка без каналов
+        if guild.unavailable:
+            return False
+        stored = self.store.get_guild(guild.id)
         
         # Ищем каналы по префиксам. Используем discord.utils.find для эффективности.
         member_channel = discord.utils.find(lambda c: c.name.startswith(MEMBER_CHANNEL_PREFIX), guild.voice_channels)
@@ -60,40 +166,75 @@ class StatsUpdater(commands.Cog):
         
         # Если на сервере нет нужных каналов, ничего не делаем.
         if not member_channel and not bot_channel:
-            return
+            return True
+
+        # Если каналы статистики пересоздали, сохраненные названия к ним больше не относятся
+        structure_hash = self._structure_hash(member_channel, bot_channel)
+        if stored and stored[2] != structure_hash:
+            self.store.forget_published(guild.id)
+        published = self.store.get_published(guild.id)
 
         # --- Вычисляем статистику ---
         # guild.member_count - самый надежный способ получить общее число участников.
+        # Если Discord его еще не прислал, используем сохраненное.
         total_members = guild.member_count
+        if total_members is None and stored:
+            total_members = stored[0]
         # Для подсчета ботов необходим кеш участников, который должен быть включен.
-        bot_count = sum(1 for member in guild.members if member.bot)
+        # Пока бот догружает участников после перезапуска, берем сохраненное значение,
+        # чтобы не опубликовать неполное число и потом не переименовывать канал обратно.
+        if guild.chunked or self.bot.is_ready():
+            bot_count = sum(1 for member in guild.members if member.bot)
+        elif stored:
+            bot_count = stored[1]
+        else:
+            bot_count = None
+        self.store.save_guild(guild.id, total_members, bot_count, structure_hash)
         
         # --- Обновляем канал с участниками ---
-        if member_channel:
+        if member_channel and total_members is not None:
             new_name = f"{MEMBER_CHANNEL_PREFIX} {total_members}"
-            # Обновляем имя, только если оно изменилось, чтобы избежать лишних запросов к API.
-            if member_channel.name != new_name:
-                try:
-                    await member_channel.edit(name=new_name, reason="Обновление статистики участников")
-                    print(f"Сервер '{guild.name}': Канал участников обновлен ({total_members}).")
-                    # Небольшая пауза, чтобы не отправлять запросы слишком часто.
-                    await asyncio.sleep(2)
-                except discord.Forbidden:
-                    print(f"Ошибка на сервере '{guild.name}': нет прав для редактирования канала участников.")
-                except Exception as e:
-                    print(f"Непредвиденная ошибка при обновлении канала участников на '{guild.name}': {e}")
+            if await self._rename(guild, member_channel, new_name, published, "Обновление статистики участников"):
+                print(f"Сервер '{guild.name}': Канал участников обновлен ({total_members}).")
+                # Небольшая пауза, чтобы не отправлять запросы слишком часто.
+                await asyncio.sleep(2)
         
         # --- Обновляем канал с ботами ---
-        if bot_channel:
+        if bot_channel and bot_count is not None:
             new_name = f"{BOT_CHANNEL_PREFIX} {bot_count}"
-            if bot_channel.name != new_name:
-                try:
-                    await bot_channel.edit(name=new_name, reason="Обновление статистики ботов")
-                    print(f"Сервер '{guild.name}': Канал ботов обновлен ({bot_count}).")
-                except discord.Forbidden:
-                    print(f"Ошибка на сервере '{guild.name}': нет прав для редактирования канала ботов.")
-                except Exception as e:
-                    print(f"Непредвиденная ошибка при обновлении канала ботов на '{guild.name}': {e}")
+            if await self._rename(guild, bot_channel, new_name, published, "Обновление статистики ботов"):
+                print(f"Сервер '{guild.name}': Канал ботов обновлен ({bot_count}).")
+        return bot_count is not None or not bot_channel
+
+    async def _rename(self, guild: discord.Guild, channel: discord.VoiceChannel, new_name: str, published: Dict[int, Tuple[str, float]], reason: str) -> bool:
+        """Переименовывает канал, только если это действительно нужно. Возвращает True, если переименовал."""
+        # Обновляем имя, только если оно изменилось, чтобы избежать лишних запросов к API.
+        if channel.name == new_name:
+            if published.get(channel.id, (None,))[0] != new_name:
+                self.store.save_published(guild.id, channel.id, new_name)
+            return False
+
+        # Не тратим лимит переименований, если этот канал только что переименовывали
+        # (например, прямо перед перезапуском бота)
+        last_published = published.get(channel.id)
+        if last_published and time.time() - last_published[1] < RENAME_COOLDOWN_SECONDS:
+            return False
+
+        try:
+            await channel.edit(name=new_name, reason=reason)
+            self.store.save_published(guild.id, channel.id, new_name)
+            return True
+        except discord.Forbidden:
+            print(f"Ошибка на сервере '{guild.name}': нет прав для редактирования канала {channel.name}.")
+        except Exception as e:
+            print(f"Непредвиденная ошибка при обновлении канала {channel.name} на '{guild.name}': {e}")
+        return False
+
+    @staticmethod
+    def _structure_hash(member_channel: Optional[discord.VoiceChannel], bot_channel: Optional[discord.VoiceChannel]) -> str:
+        """Хеш набора каналов статистики: меняется, когда каналы пересоздают."""
+        ids = f"{member_channel.id if member_channel else 0}:{bot_channel.id if bot_channel else 0}"
+        return hashlib.sha1(ids.encode()).hexdigest()
 
 
 def setup(bot: commands.Bot):
@@ -5,6 +5,8 @@ import asyncio
 import sys
 from discord.ext import commands
 
+from api_scheduler import ApiScheduler
+
 # --- НАСТРОЙКИ БОТА ---
 
 
@@ -17,17 +19,19 @@ intents = discord.Intents.all()
 # Создаем экземпляр бота
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Приоритетные очереди для запросов к API: ответы на команды не ждут массовую настройку и статистику
+ApiScheduler().install(bot.http)
+
 
 # --- ЗАГРУЗКА МОДУЛЕЙ (COGS) ---
 
-@bot.event
-async def on_ready():
-    """Событие, которое вызывается, когда бот успешно подключился к Discord."""
-    print(f'✅ Бот {bot.user.name} успешно запущен!')
-    print(f'ID бота: {bot.user.id}')
-    print('------')
-    
-    # Загружаем все модули из папки 'cogs'
+def load_cogs():
+    """Загружает все модули из папки 'cogs'.
+
+    Вызывается до подключения к Discord, а не в on_ready: так фоновые задачи
+    (например, статистика) стартуют сразу, не дожидаясь загрузки всех участников,
+    а повторный on_ready после переподключения не пытается загрузить модули второй раз.
+    """
     loaded_cogs = 0
     for filename in os.listdir('./cogs'):
         if filename.endswith('.py') and 'config' not in filename:
@@ -41,6 +45,13 @@ async def on_ready():
     print('------')
     print(f"🚀 Всего загружено модулей: {loaded_cogs}")
 
+
+@bot.event
+async def on_ready():
+    """Событие, которое вызывается, когда бот успешно подключился к Discord."""
+    print(f'✅ Бот {bot.user.name} успешно запущен!')
+    print(f'ID бота: {bot.user.id}')
+
     print('------')
     print("🔄 Синхронизирую команды с Discord...")
     try:
@@ -61,4 +72,5 @@ if __name__ == "__main__":
         print("на настоящий токен вашего бота от Discord.")
         print("======================================================")
     else:
+        load_cogs()
         bot.run(BOT_TOKEN) 
\ No newline at end of file